@@ -0,0 +1,37 @@
+import os
+
+# ── SERVER ─────────────────────────────
+# Run with: gunicorn image-backend:app
+# Each request spends most of its time waiting on OpenAI, so gevent
+# workers keep many edits in flight per process instead of one.
+bind = f"0.0.0.0:{os.environ.get('PORT', 5050)}"
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+worker_class = "gevent"
+worker_connections = 500
+timeout = 120
+
+# ── WARM-UP ────────────────────────────
+# Not preload_app: importing the app in the master would load ssl/requests
+# before the gevent worker monkey-patches them. Warm each worker instead,
+# after the app is imported and before it accepts connections.
+def post_worker_init(worker):
+    import io
+    import openai
+    from PIL import Image
+
+    buf = io.BytesIO()
+    Image.new("RGBA", (16, 16)).resize((8, 8), Image.LANCZOS).save(buf, format="PNG")
+
+    # A free call opens a TLS connection in the app's shared keep-alive pool.
+    # Hard timeouts (x3 connect attempts from the adapter's retries) keep this
+    # well inside the arbiter's boot timeout when the network is unreachable.
+    try:
+        openai.requestssession.get(
+            f"{openai.api_base}/models",
+            headers={"Authorization": f"Bearer {openai.api_key}"},
+            timeout=(3, 5),
+        ).close()
+    except Exception as e:
+        worker.log.warning("OpenAI warm-up failed: %s", e)
+
+    worker.log.info("Worker %s warmed up", worker.pid)
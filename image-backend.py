@@ -1,35 +1,255 @@
 import os
 import io
-import base64
+import atexit
+import logging
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from logging.handlers import QueueHandler, QueueListener
 from dotenv import load_dotenv
-from flask import Flask, request, jsonify
+from flask import Flask, Request, Response, request, jsonify
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
+from werkzeug.exceptions import RequestEntityTooLarge
+import requests
+from requests.adapters import HTTPAdapter
+import gevent.threadpool
+from gevent import monkey
 from PIL import Image
+from blake3 import blake3
+import orjson
+import boto3
 import openai
 
+# Register every PIL codec plugin now rather than on the first upload
+Image.init()
+
+# Optional libvips fast path; each image-pool thread runs single-threaded vips
+os.environ.setdefault("VIPS_CONCURRENCY", "1")
+try:
+    import pyvips
+    logging.getLogger("pyvips").setLevel(logging.WARNING)
+except (ImportError, OSError):
+    pyvips = None
+
 # ── CONFIG ─────────────────────────────
 load_dotenv()
+
+# Request threads only enqueue records; formatting and stdout writes
+# happen on the listener's thread
+_log_queue = queue.Queue(-1)
+_log_stream = logging.StreamHandler()
+_log_stream.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+_log_listener = QueueListener(_log_queue, _log_stream)
+logging.getLogger().addHandler(QueueHandler(_log_queue))
+logging.getLogger().setLevel(logging.INFO)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+log = logging.getLogger("image-backend")
+
 openai.api_key = os.getenv("OPENAI_API_KEY")
 
+class SharedSession(requests.Session):
+    """Session whose pool survives the SDK's close() every 180s per thread"""
+
+    def close(self):
+        pass
+
+# One keep-alive pool shared by all requests. The SDK's default is a session
+# per thread, which under gevent means a new TLS handshake for every edit.
+_openai_session = SharedSession()
+# Keep the SDK's own 2 connection retries so a dropped keep-alive socket is redialled
+_openai_session.mount("https://", HTTPAdapter(pool_maxsize=100, max_retries=2))
+openai.requestssession = _openai_session
+atexit.register(requests.Session.close, _openai_session)
+
+class ORJSONProvider(DefaultJSONProvider):
+    """Route jsonify() and request.get_json() through orjson"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+class InMemoryUploadRequest(Request):
+    """Keep uploads in a BytesIO; Werkzeug spools anything over 500KB to disk"""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return io.BytesIO()
+
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
+app.request_class = InMemoryUploadRequest
+
+# Werkzeug refuses larger bodies before the multipart parser buffers them,
+# which also bounds the in-memory upload buffers above
+app.config["MAX_CONTENT_LENGTH"] = 10 * 1024 * 1024
+MIN_CONTENT_LENGTH = 100
+OPENAI_EDIT_MAX_BYTES = 4 * 1024 * 1024  # edit endpoint's limit per image
 CORS(app, resources={r"/*": {"origins": ["https://ai-image-modifier.web.app"]}})
 
+# Optional: copy results to our own bucket, since OpenAI's URLs expire in ~1h
+CDN_BUCKET = os.getenv("CDN_BUCKET")
+CDN_BASE_URL = os.getenv("CDN_BASE_URL", "").rstrip("/")
+if bool(CDN_BUCKET) != bool(CDN_BASE_URL):
+    raise RuntimeError("CDN_BUCKET and CDN_BASE_URL must be set together")
+_s3 = boto3.client("s3") if CDN_BUCKET else None
+
+PREPARED_CACHE_SIZE = 16  # ~3MB of PNG per entry
+_prepared_cache = OrderedDict()
+_prepared_cache_lock = threading.Lock()
+
+RESULT_CACHE_SIZE = 256
+RESULT_CACHE_TTL = 50 * 60  # OpenAI result URLs expire after ~1h
+_result_cache = OrderedDict()
+_result_cache_lock = threading.Lock()
+
+# Edits currently running, keyed like the result cache, so duplicates can wait on them
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+# Under gevent, stdlib executor threads are greenlets, so use gevent's native
+# thread pool to keep PIL work (which releases the GIL) off the event loop.
+# That pool only accepts work from its creating thread, so the threaded dev
+# server and sync/gthread workers get the stdlib executor instead.
+if monkey.is_module_patched("threading"):
+    _image_pool = gevent.threadpool.ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+else:
+    _image_pool = ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+
 # ── UTILS ──────────────────────────────
-def prepare_image(image_bytes):
+def upload_size(stream):
+    """Return the byte length of a seekable upload stream"""
+    stream.seek(0, io.SEEK_END)
+    size = stream.tell()
+    stream.seek(0)
+    return size
+
+def sniff_image_type(header):
+    """Identify JPEG/PNG/GIF/WebP from an upload's first 12 bytes, else None"""
+    if header.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if header.startswith(b"\xff\xd8\xff"):
+        return "jpeg"
+    if header[:6] in (b"GIF87a", b"GIF89a"):
+        return "gif"
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "webp"
+    return None
+
+def is_edit_ready_png(header):
+    """True if the PNG IHDR says 1024x1024, 8-bit RGBA (colour type 6)"""
+    return (
+        header[:8] == b"\x89PNG\r\n\x1a\n"
+        and header[12:16] == b"IHDR"
+        and int.from_bytes(header[16:20], "big") == 1024
+        and int.from_bytes(header[20:24], "big") == 1024
+        and header[24:26] == b"\x08\x06"
+    )
+
+def prepare_image(stream):
     """Convert image to 1024x1024 RGBA square PNG"""
-    img = Image.open(io.BytesIO(image_bytes)).convert("RGBA")
+    # Uploads from a previous edit round-trip are already in the target format,
+    # unless they were saved with so little compression that OpenAI would refuse them
+    header = stream.read(26)
+    stream.seek(0)
+    if is_edit_ready_png(header) and upload_size(stream) <= OPENAI_EDIT_MAX_BYTES:
+        return io.BytesIO(stream.read())
+
+    if pyvips is not None:
+        return prepare_image_vips(stream)
+
+    img = Image.open(stream)
+    # Let JPEG decode at 1/2, 1/4 or 1/8 scale when the source is far above 1024px
+    img.draft(None, (1024, 1024))
+    img = img.convert("RGBA")
 
     min_dim = min(img.width, img.height)
     left = (img.width - min_dim) // 2
     top = (img.height - min_dim) // 2
-    img = img.crop((left, top, left + min_dim, top + min_dim))
-    img = img.resize((1024, 1024), Image.LANCZOS)
+    box = (left, top, left + min_dim, top + min_dim)
+    # Resample straight from the crop box (no intermediate crop copy); reducing_gap
+    # box-reduces by an integer factor first when shrinking more than 3x
+    img = img.resize((1024, 1024), Image.LANCZOS, box=box, reducing_gap=3.0)
 
+    # Fast zlib level: the PNG is uploaded once, not stored. Fall back to the
+    # default level if that pushes it past OpenAI's size limit.
     output = io.BytesIO()
-    img.save(output, format="PNG")
+    img.save(output, format="PNG", compress_level=1)
+    if output.tell() > OPENAI_EDIT_MAX_BYTES:
+        output = io.BytesIO()
+        img.save(output, format="PNG")
     output.seek(0)
     return output
 
+def prepare_image_vips(stream):
+    """libvips prepare_image: shrink-on-load, cover-resize and centre crop in one pass"""
+    # no_rotate: match the PIL path, which ignores EXIF orientation
+    img = pyvips.Image.thumbnail_buffer(
+        stream.read(), 1024, height=1024, crop="centre", no_rotate=True
+    )
+    img = img.colourspace("srgb")
+    if not img.hasalpha():
+        img = img.bandjoin(255)
+    png = img.write_to_buffer(".png", compression=1)
+    if len(png) > OPENAI_EDIT_MAX_BYTES:
+        png = img.write_to_buffer(".png")
+    return io.BytesIO(png)
+
+def hash_upload(stream):
+    """Hex digest of an upload stream, leaving it rewound"""
+    digest = blake3()
+    for chunk in iter(lambda: stream.read(64 * 1024), b""):
+        digest.update(chunk)
+    stream.seek(0)
+    return digest.hexdigest()
+
+def prepare_image_cached(digest, stream):
+    """prepare_image() memoised by upload digest so prompt retries skip PIL"""
+    with _prepared_cache_lock:
+        png = _prepared_cache.get(digest)
+        if png is not None:
+            _prepared_cache.move_to_end(digest)
+    if png is None:
+        png = _image_pool.submit(prepare_image, stream).result().getvalue()
+        with _prepared_cache_lock:
+            _prepared_cache[digest] = png
+            if len(_prepared_cache) > PREPARED_CACHE_SIZE:
+                _prepared_cache.popitem(last=False)
+    return io.BytesIO(png)
+
+def result_cache_key(digest, prompt):
+    """Key an edit by upload digest and whitespace/case-normalised prompt"""
+    return f"{digest}:{' '.join(prompt.lower().split())}"
+
+def get_cached_result(key):
+    """Return a cached edit result that is still within its TTL, else None"""
+    with _result_cache_lock:
+        entry = _result_cache.get(key)
+        if entry is None:
+            return None
+        stored_at, result = entry
+        if time.monotonic() - stored_at > RESULT_CACHE_TTL:
+            del _result_cache[key]
+            return None
+        _result_cache.move_to_end(key)
+        return result
+
+def store_result(key, result):
+    with _result_cache_lock:
+        _result_cache[key] = (time.monotonic(), result)
+        _result_cache.move_to_end(key)
+        if len(_result_cache) > RESULT_CACHE_SIZE:
+            _result_cache.popitem(last=False)
+
+def drop_result(key):
+    with _result_cache_lock:
+        _result_cache.pop(key, None)
+
 def generate_white_mask(size=(1024, 1024)):
     """Return a full-white mask to edit entire image"""
     mask = Image.new("L", size, 255)  # Grayscale white mask
@@ -38,9 +258,94 @@ def generate_white_mask(size=(1024, 1024)):
     output.seek(0)
     return output
 
+# The mask is identical for every request, so encode it once
+_WHITE_MASK_PNG = generate_white_mask().getvalue()
+
+def rehost_image(source_url, key, cache_key):
+    """Stream a DALL·E result into the CDN bucket with a long cache lifetime"""
+    try:
+        with requests.get(source_url, stream=True, timeout=60) as resp:
+            resp.raise_for_status()
+            resp.raw.decode_content = True
+            _s3.upload_fileobj(
+                resp.raw,
+                CDN_BUCKET,
+                key,
+                ExtraArgs={
+                    "ContentType": "image/png",
+                    "CacheControl": "public, max-age=31536000, immutable",
+                },
+            )
+        log.info("☁️ Re-hosted image: %s", key)
+    except Exception as e:
+        log.error("💥 Error re-hosting image: %s", e)
+        # Stop serving the cached cdn_url, which will never resolve
+        drop_result(cache_key)
+
+def single_flight(key, fn):
+    """Run fn() once per key at a time; concurrent callers share its outcome"""
+    with _inflight_lock:
+        future = _inflight.get(key)
+        leader = future is None
+        if leader:
+            future = _inflight[key] = Future()
+
+    if not leader:
+        log.info("⏳ Waiting on identical in-flight edit")
+        return future.result()
+
+    try:
+        result = fn()
+        future.set_result(result)
+        return result
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _inflight_lock:
+            del _inflight[key]
+
+def run_edit(cache_key, digest, stream, prompt):
+    """Prepare the upload, send it to the DALL·E 2 edit endpoint and cache the result"""
+    img = prepare_image_cached(digest, stream)
+    mask = io.BytesIO(_WHITE_MASK_PNG)
+
+    log.info("🛠️ Sending to OpenAI...")
+    response = openai.Image.create_edit(
+        image=img,
+        mask=mask,
+        prompt=prompt,
+        size="1024x1024",
+        n=1,
+        response_format="url"
+    )
+
+    image_url = response["data"][0]["url"]
+    result = {
+        "image_url": image_url,
+        "method": "DALL·E 2 Edit",
+        "prompt_used": prompt
+    }
+
+    key = f"edits/{uuid.uuid4().hex}.png" if CDN_BUCKET else None
+    if key:
+        result["cdn_url"] = f"{CDN_BASE_URL}/{key}"
+
+    store_result(cache_key, result)
+
+    # Copy in the background once cached, so a failed copy can evict the entry;
+    # clients switch to cdn_url once it is live
+    if key:
+        threading.Thread(target=rehost_image, args=(image_url, key, cache_key), daemon=True).start()
+
+    return result
+
 # ── ROUTES ─────────────────────────────
 @app.route("/edit-image", methods=["POST"])
 def edit_image():
+    if request.content_length is not None and request.content_length < MIN_CONTENT_LENGTH:
+        return jsonify({"error": "Request body too small"}), 400
+
     try:
         img_file = request.files.get("image")
         prompt = request.form.get("prompt", "").strip()
@@ -48,39 +353,44 @@ def edit_image():
         if not img_file or not prompt:
             return jsonify({"error": "Missing image or prompt"}), 400
 
-        image_bytes = img_file.read()
-        if not image_bytes:
+        # Decode straight from Werkzeug's upload stream instead of copying it into bytes
+        if not upload_size(img_file.stream):
             return jsonify({"error": "Empty image file"}), 400
 
-        print("📥 Received image:", img_file.filename)
-        print("📝 Prompt:", prompt)
+        # Cheap magic-byte check so PDFs and the like never reach PIL or OpenAI
+        header = img_file.stream.read(12)
+        img_file.stream.seek(0)
+        if sniff_image_type(header) is None:
+            return jsonify({"error": "Unsupported image type"}), 415
+
+        log.info("📥 Received image: %s", img_file.filename)
+        log.info("📝 Prompt: %s", prompt)
 
-        img = prepare_image(image_bytes)
-        mask = generate_white_mask()
+        digest = hash_upload(img_file.stream)
+        cache_key = result_cache_key(digest, prompt)
+        cached = get_cached_result(cache_key)
+        if cached is not None:
+            log.info("♻️ Returning cached edit")
+            return jsonify(cached)
 
-        print("🛠️ Sending to OpenAI...")
-        response = openai.Image.create_edit(
-            image=img,
-            mask=mask,
-            prompt=prompt,
-            size="1024x1024",
-            n=1,
-            response_format="url"
+        result = single_flight(
+            cache_key, lambda: run_edit(cache_key, digest, img_file.stream, prompt)
         )
+        return jsonify(result)
 
-        return jsonify({
-            "image_url": response["data"][0]["url"],
-            "method": "DALL·E 2 Edit",
-            "prompt_used": prompt
-        })
+    except RequestEntityTooLarge:
+        return jsonify({"error": "Image too large"}), 413
 
     except Exception as e:
-        print("💥 Error during editing:", str(e))
+        log.error("💥 Error during editing: %s", e)
         return jsonify({"error": "Internal Server Error", "details": str(e)}), 500
 
+# Serialized once; a fresh Response per call since flask-cors sets headers on it
+_HEALTH_BODY = b'{"status":"ok","message":"Image editor backend is running."}'
+
 @app.route("/health", methods=["GET"])
 def health_check():
-    return jsonify({"status": "ok", "message": "Image editor backend is running."})
+    return Response(_HEALTH_BODY, mimetype="application/json")
 
 # ── RUN LOCALLY ───────────────────────
 if __name__ == "__main__":